@@ -54,49 +54,49 @@ def cluster_records(records, pid, threads):
 def get_bold_clusters(f, pid, threads):
     """
     Iterates a fasta file sorted by species and clusters sequence for each
-    species
+    species. Clusters are yielded as soon as all records for a BOLD id have
+    been read so that only one group of records is kept in memory at a time.
 
     :param f: input fasta file
     :param pid: percent identity to cluster by
-    :return: cluster dictionary (species as keys, records as values)
+    :return: generator of (BOLD id, clustered records) tuples
     """
-    bold_groups = {}
-    clusters = {}
+    group = []
+    clusters = 0
     seqs = 0
-    sp = ""
+    current_id = None
+    i = -1
     sys.stderr.write(f"Reading {f} and clustering with vsearch...\n")
     for i, record in enumerate(parse(f, "fasta")):
         bold_id = (record.description).split(";")[-1]
-        if i == 0:
-            current_id = bold_id
-            bold_groups[bold_id] = [record]
-            continue
         # If the next record is from the same species, add it to the list
         if bold_id == current_id:
-            bold_groups[bold_id].append(record)
+            group.append(record)
+            continue
         # If not the same, attempt to cluster the stored sequences
-        else:
-            clusters[current_id] = cluster_records(
-                bold_groups[current_id], pid, threads
-            )
-            seqs += len(clusters[current_id])
-            current_id = bold_id
-            bold_groups[bold_id] = [record]
+        if group:
+            records = cluster_records(group, pid, threads)
+            clusters += 1
+            seqs += len(records)
+            yield current_id, records
+        current_id = bold_id
+        group = [record]
     # Cluster the final sequences
-    clusters[current_id] = cluster_records(bold_groups[current_id], pid, threads)
-    seqs += len(clusters[current_id])
+    if group:
+        records = cluster_records(group, pid, threads)
+        clusters += 1
+        seqs += len(records)
+        yield current_id, records
     sys.stderr.write(
         f"Records read: {i+1}\n"
-        f"BOLD IDs clustered: {len(clusters)}\n"
+        f"BOLD IDs clustered: {clusters}\n"
         f"Sequence clusters: {seqs}\n"
     )
-    return clusters
 
 
 def main(args):
-    seq_clusters = get_bold_clusters(args.fasta, args.pid, args.threads)
     with open(args.outfile, "w") as fhout:
-        for bold_id, records in seq_clusters.items():
+        for bold_id, records in get_bold_clusters(args.fasta, args.pid, args.threads):
             write_fasta(records, fhout, "fasta")
 
 
@@ -2,15 +2,17 @@
 
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 import sys
 import shutil
 import os
-import urllib.request
 import datetime
-import json
 import re
 
+# Matches taxa labels filled in by fill_unassigned, e.g. 'Gastropoda_XX'
+UNASSIGNED_REGEX = re.compile(".+(_[X]+)$")
+# Matches the cluster size annotation added to headers by vsearch
+SEQS_REGEX = re.compile(r";seqs=\d+")
+
 
 def logg(f):
     """
@@ -46,26 +48,6 @@ def logg(f):
     return wrapper
 
 
-def api_match_species(bin_id):
-    """
-    This function uses the GBIF API to match a BIN id to a species name.
-    It's only used as a fallback in case the add_species function does
-    not work, for instance due to improper taxonomic info added for a BIN.
-
-    :param bin_id: The BOLD bin id to match
-    :return: Species name or NaN
-    """
-    try:
-        with urllib.request.urlopen(
-            f"https://api.gbif.org/v1/species/match?name={bin_id}"
-        ) as response:
-            json_text = response.read()
-        response_dict = json.loads(json_text)
-        return response_dict["species"]
-    except:
-        return np.nan
-
-
 def add_species(species_bins, bin_tax_df, parent_df):
     """
     This function goes through putative species BINs, i.e. BINs that are
@@ -77,18 +59,15 @@ def add_species(species_bins, bin_tax_df, parent_df):
     :param parent_df: dataframe with parents to the species bins
     :return: the taxonmomic dataframe with species names added
     """
-    for bold_id in tqdm(species_bins, unit=" BINs", desc="adding species"):
-        parent = bin_tax_df.loc[bold_id, "parentNameUsageID"]
-        if len(parent_df.loc[parent_df.taxonID == parent]) == 0:
-            continue
-        try:
-            # Try to get the species name from the parent backbone
-            bin_tax_df.loc[bold_id, "species"] = parent_df.loc[
-                parent_df.taxonID == parent, "canonicalName"
-            ].values[0]
-        except IndexError:
-            # If that fails for some reason, do one attempt with the API
-            bin_tax_df.loc[bold_id, "species"] = api_match_species(bold_id)
+    # Lookup of parent taxonID -> species name, keeping the first name per parent
+    parent_names = parent_df.drop_duplicates("taxonID").set_index("taxonID")[
+        "canonicalName"
+    ]
+    parents = bin_tax_df.loc[species_bins, "parentNameUsageID"]
+    # Get the species name from the parent backbone, BINs without a parent
+    # in parent_df are left unassigned
+    species = parents.map(parent_names)
+    bin_tax_df.loc[species_bins, "species"] = species
     return bin_tax_df
 
 
@@ -102,30 +81,18 @@ def find_non_unique_lineages(dataf, ranks):
     :return: list of rank:name items
     """
     bin_tax_profiles = dataf.reset_index().groupby(ranks).size().reset_index()
-    tax_strings = {}
     dups = []
     # Iterate middle ranks
     sys.stderr.write("Looking for non-unique lineages in ranks\n")
     for rank in ranks[1:-1]:
-        tax_strings[rank] = {}
-        for taxa in tqdm(
-            bin_tax_profiles[rank].unique(),
-            total=len(bin_tax_profiles[rank].unique()),
-            desc=f"{rank}: ",
-        ):
-            try:
-                tax_strings[rank][taxa]
-            except KeyError:
-                tax_strings[rank][taxa] = []
-            # Get all rows with taxa
-            rows = bin_tax_profiles.loc[bin_tax_profiles[rank] == taxa]
-            parent_ranks = ranks[0 : ranks.index(rank)]
-            for row in rows.iterrows():
-                tax_strings[rank][taxa].append(
-                    ";".join(row[1][p] for p in parent_ranks)
-                )
-            if len(set(tax_strings[rank][taxa])) > 1:
-                dups.append(f"{rank}:{taxa}")
+        parent_ranks = ranks[0 : ranks.index(rank)]
+        # Count distinct parent lineages per taxa, keeping taxa in order of appearance
+        lineages = (
+            bin_tax_profiles.drop_duplicates(parent_ranks + [rank])
+            .groupby(rank, sort=False)
+            .size()
+        )
+        dups += [f"{rank}:{taxa}" for taxa in lineages.index[lineages > 1]]
     sys.stderr.write(
         f"Found {len(dups)} rank/taxa combinations with non-unique lineages\n"
     )
@@ -141,24 +108,21 @@ def check_uniqueness(df, bin_df, group_ranks, rank, name):
     :param group_ranks:
     :return:
     """
-    regex = re.compile(".+(_[X]+)$")
-    _bins_to_remove = []
-    for row in df.groupby(group_ranks).size().reset_index().iterrows():
-        # Check whether parent ranks have '_X' in them
-        unassigned = sum(
-            [1 if x else 0 for x in [regex.match(row[1][rank]) for rank in group_ranks]]
-        )
-        # if all parent ranks (up to kingdom) are unassigned, mark this bin for removal
-        if unassigned == len(group_ranks) - 1:
-            # Mark BINs with lineage to be deleted
-            _ = df.copy()
-            for r in group_ranks:
-                _ = _.loc[_[r] == row[1][r]]
-            _bins_to_remove += list(_.loc[_[rank] == name].bold_id.values)
-    return _bins_to_remove
+    # Count parent ranks with '_X' in them for each BIN
+    unassigned = sum(
+        df[r].str.match(UNASSIGNED_REGEX, na=False).astype(int) for r in group_ranks
+    )
+    # if all parent ranks (up to kingdom) are unassigned, mark BINs with this lineage for removal
+    remove = (
+        (unassigned == len(group_ranks) - 1)
+        & df[group_ranks].notna().all(axis=1)
+        & (df[rank] == name)
+    )
+    # Order BINs by lineage, as they would be when iterating groups of lineages
+    return list(df.loc[remove].sort_values(group_ranks, kind="stable").bold_id.values)
 
 
-def prefix_taxa(dataf, d, rank, name, group_ranks, parent_rank, child_ranks):
+def prefix_taxa(dataf, idx, rank, name, group_ranks, parent_rank, child_ranks):
     """
     Prefixes non-unique taxa labels with the parent rank, e.g.
     Plantae 	Rhodophyta 	Florideophyceae 	Gigartinales 	Acrotylaceae 	Acrotylus 	Acrotylus_X
@@ -170,7 +134,7 @@ def prefix_taxa(dataf, d, rank, name, group_ranks, parent_rank, child_ranks):
 
 
     :param dataf:
-    :param d:
+    :param idx: index labels of rows to prefix
     :param rank:
     :param name:
     :param group_ranks:
@@ -178,14 +142,13 @@ def prefix_taxa(dataf, d, rank, name, group_ranks, parent_rank, child_ranks):
     :param child_ranks:
     :return:
     """
-    for key, row_dict in d.items():
-        parent = row_dict[parent_rank]
-        for child_rank in child_ranks:
-            row_dict[child_rank] = row_dict[child_rank].replace(
-                name, f"{parent}_{name}"
-            )
-        d[key] = row_dict
-    dataf = pd.concat([dataf.drop(d.keys()), pd.DataFrame(d).T])
+    parents = dataf.loc[idx, parent_rank].values
+    # Update the affected rows in place instead of rebuilding the dataframe
+    for child_rank in child_ranks:
+        dataf.loc[idx, child_rank] = [
+            taxa.replace(name, f"{parent}_{name}")
+            for taxa, parent in zip(dataf.loc[idx, child_rank].values, parents)
+        ]
     return dataf
 
 
@@ -214,17 +177,18 @@ def clean_up_non_unique_lineages(dataf, dups, ranks):
     for item in dups:
         rank, name = item.split(":")
         log[name] = {"rank": rank}
-        group_ranks = ranks[: ranks.index(rank)]
-        parent_rank = ranks[ranks.index(rank) - 1]
-        child_ranks = ranks[ranks.index(rank) :]
-        _df = dataf.loc[dataf[rank] == name].copy()
+        rank_index = ranks.index(rank)
+        group_ranks = ranks[:rank_index]
+        parent_rank = ranks[rank_index - 1]
+        child_ranks = ranks[rank_index:]
+        # Boolean indexing already returns a new frame, so no extra copy is needed
+        _df = dataf.loc[dataf[rank] == name]
         _bins_to_remove = check_uniqueness(_df, dataf, group_ranks, rank, name)
         # Test if lineages are unique after removing BINs
         if (
-            _df.loc[~_df.bold_id.isin(_bins_to_remove)]
-            .groupby(group_ranks)
-            .size()
-            .reset_index()
+            _df.loc[~_df.bold_id.isin(_bins_to_remove), group_ranks]
+            .dropna()
+            .drop_duplicates()
             .shape[0]
             == 1
         ):
@@ -235,9 +199,8 @@ def clean_up_non_unique_lineages(dataf, dups, ranks):
             log[name]["bins_removed"] = ",".join(_bins_to_remove)
         else:
             # if not, prefix the name with the parent rank
-            d = _df.to_dict(orient="index")
             dataf = prefix_taxa(
-                dataf, d, rank, name, group_ranks, parent_rank, child_ranks
+                dataf, _df.index, rank, name, group_ranks, parent_rank, child_ranks
             )
             log[name]["decision"] = "prefixing with parent rank name"
             log[name]["bins_removed"] = ""
@@ -264,67 +227,47 @@ def fill_unassigned(
     :param ranks: Ranks to iterate through
     :return: A dataframe with filled ranks
     """
-    d = {}
-    # Drop the bins to check into separate dataframe
-    others = df.drop(bins).loc[:, ranks]
-    # Extract bins to check for iteration
-    df = df.loc[bins, ranks]
-    for bold_bin in tqdm(
-        bins, unit=" BINs", total=len(bins), desc="filling unassigned ranks"
-    ):
-        unknowns = 0
-        row = df.loc[bold_bin].to_dict()
-        for rank in ranks:
-            # If an NaN entry is found
-            if row[rank] != row[rank]:
-                # Get the previous rank and its classification
-                prev_rank = ranks.index(rank) - 1
-                prev = ranks[prev_rank]
-                # If this is the first time we're adding a suffix include the underscore
-                if unknowns == 0:
-                    row[rank] = row[prev] + "_X"
-                else:
-                    row[rank] = row[prev] + "X"
-                unknowns += 1
-            else:
-                # Reset the unknowns counter in case there are intermediate unassigned ranks
-                unknowns = 0
-        d[bold_bin] = row
-    return pd.concat([pd.DataFrame(d).T, others])
+    # Rank columns as object dtype so that filled names can be written back
+    df = df.loc[:, ranks].astype(object)
+    # Extract rank values for the bins to fill
+    values = df.loc[bins, ranks].to_numpy(copy=True)
+    unassigned = pd.isna(values)
+    # Fill one rank at a time for all bins, using the (already filled) previous rank
+    for i in range(1, len(ranks)):
+        prev = values[:, i - 1]
+        fill = unassigned[:, i] & pd.notna(prev)
+        # If this is the first unassigned rank in a row include the underscore
+        first = fill & ~unassigned[:, i - 1]
+        values[first, i] = prev[first] + "_X"
+        # Otherwise extend the suffix of the previous rank
+        extend = fill & unassigned[:, i - 1]
+        values[extend, i] = prev[extend] + "X"
+    df.loc[bins, ranks] = values
+    return df
 
 
 @logg
 def start(dataf):
     """
-    Dummy function to generate a copy of the starting dataframe
+    Dummy function to log the size of the starting dataframe. The dataframe
+    is returned as is, since the following steps return new dataframes.
 
     :param dataf: Starting dataframe
-    :return: copy of dataframe
+    :return: dataframe
     """
-    return dataf.copy()
+    return dataf
 
 
 @logg
 def extract_bold_bins(dataf):
     """
     Returns the dataframe filtered to only rows with a BOLD BIN id, i.e.
-    excluding NaN values
+    excluding NaN values, with remaining NaN values filled
 
     :param dataf: Input dataframe
     :return: Filtered dataframe
     """
-    return dataf.loc[dataf.bold_id == dataf.bold_id]
-
-
-@logg
-def fillna(dataf):
-    """
-    Fills NaN values in dataframe and returns it
-
-    :param dataf: Input dataframe
-    :return: Processed dataframe
-    """
-    return dataf.fillna("")
+    return dataf.loc[dataf.bold_id == dataf.bold_id].fillna("")
 
 
 @logg
@@ -355,23 +298,21 @@ def write_seqs(seq_df, outfile, tmpfile, ranks):
     :param ranks: list of ranks to write in header
     :return: Dataframe of taxonomic information that remains
     """
-    old_index = []
-    new_index = []
     # Sort sequences by BOLD IDs
     sys.stderr.write("Sorting sequences by BOLD IDs\n")
     seq_df = seq_df.sort_values("bold_id")
     tmpfile = os.path.expandvars(tmpfile)
     outfile = os.path.abspath(outfile)
+    # Build headers at once, with ranks and BOLD id separated by ';'
+    desc = seq_df[ranks[0]].str.cat(
+        [seq_df[x] for x in ranks[1:] + ["bold_id"]], sep=";"
+    )
+    sys.stderr.write(f"Writing {seq_df.shape[0]} sequences to temporary directory\n")
     with open(tmpfile, "w") as fhout:
-        for r in tqdm(
-            seq_df.iterrows(),
-            desc=f"Writing sequences to temporary directory",
-            unit=" seqs",
-        ):
-            record_id, row = r
-            seq = row["seq"]
-            desc = ";".join([row[x] for x in ranks + ["bold_id"]])
-            fhout.write(f">{record_id} {desc}\n{seq}\n")
+        fhout.writelines(
+            f">{record_id} {header}\n{seq}\n"
+            for record_id, header, seq in zip(seq_df.index, desc, seq_df["seq"])
+        )
     sys.stderr.write(f"Moving {tmpfile} to {outfile}\n")
     shutil.move(tmpfile, outfile)
     return seq_df.drop("seq", axis=1)
@@ -403,7 +344,7 @@ def filter(sm):
         nrows=nrows,
     )
     sys.stderr.write(f"{occurrences.shape[0]} records read\n")
-    occurrences = occurrences.pipe(start).pipe(extract_bold_bins).pipe(fillna)
+    occurrences = occurrences.pipe(start).pipe(extract_bold_bins)
     ##################################
     ### Read and process sequences ###
     ##################################
@@ -446,7 +387,9 @@ def filter(sm):
     ### Remove duplicate records ###
     ################################
     sys.stderr.write(f"Removing duplicate records\n")
-    seq_df_nr = seq_df.groupby("record_id").first().reset_index()
+    seq_df_nr = seq_df.drop_duplicates(subset="record_id", keep="first").sort_values(
+        "record_id", ignore_index=True
+    )
     sys.stderr.write(
         f"{seq_df.shape[0] - seq_df_nr.shape[0]} rows removed, {seq_df_nr.shape[0]} rows remaining\n"
     )
@@ -533,14 +476,13 @@ def clean_fasta(sm):
     :param sm: snakemake object
     :return:
     """
-    from Bio import SeqIO
-    import re
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
 
     with open(sm.input.fasta, "r") as fhin, open(sm.output.fasta, "w") as fhout:
-        for record in SeqIO.parse(fhin, "fasta"):
-            desc = (record.description).lstrip("centroid=")
-            desc = re.split(";seqs=\d+", desc)[0]
-            fhout.write(f">{desc}\n{record.seq}\n")
+        for title, seq in SimpleFastaParser(fhin):
+            desc = title.lstrip("centroid=")
+            desc = SEQS_REGEX.split(desc)[0]
+            fhout.write(f">{desc}\n{seq}\n")
 
 
 def format_fasta(sm):
@@ -570,29 +512,26 @@ def format_fasta(sm):
     ranks = sm.params.ranks
     # if "species" in ranks:
     #    ranks.remove("species")
-    from Bio import SeqIO
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
 
     info = pd.read_csv(sm.input.info, sep="\t", index_col=0, header=0)
-    with open(sm.output.assignTaxaFasta, "w") as fh1, open(
-        sm.output.addSpeciesFasta, "w"
-    ) as fh2:
-        for record in SeqIO.parse(sm.input.fasta, "fasta"):
-            names = []
-            id = record.id
-            rec_info = info.loc[id.lstrip("centroid=")]
-            # Iterate ranks and add names as long as they are not NaN
-            for r in ranks:
-                n = rec_info[r]
-                if n == n:
-                    names.append(n)
-                else:
-                    break
-            id_tax = ";".join(names) + ";"
-            fh1.write(f">{id_tax}\n{record.seq}\n")
-            species = rec_info["species"]
-            bold_id = rec_info["bold_id"]
-            id_spec = f"{id} {species}"
-            fh2.write(f">{id_spec}\n{record.seq}\n")
+    # Build headers for all records up front, adding rank names as long as
+    # they are not NaN
+    names = info[ranks]
+    assigned = names.notna().cumprod(axis=1).astype(bool)
+    id_tax = pd.Series("", index=info.index)
+    for r in ranks:
+        id_tax += (names[r].astype(str) + ";").where(assigned[r], "")
+    id_tax = dict(zip(info.index, id_tax.replace("", ";")))
+    species = dict(zip(info.index, info["species"].astype(str)))
+    with open(sm.input.fasta, "r") as fhin, open(
+        sm.output.assignTaxaFasta, "w"
+    ) as fh1, open(sm.output.addSpeciesFasta, "w") as fh2:
+        for title, seq in SimpleFastaParser(fhin):
+            id = title.split(None, 1)[0]
+            key = id.lstrip("centroid=")
+            fh1.write(f">{id_tax[key]}\n{seq}\n")
+            fh2.write(f">{id} {species[key]}\n{seq}\n")
 
 
 def main(sm):
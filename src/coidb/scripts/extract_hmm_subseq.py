@@ -33,15 +33,22 @@ AATAAATAACATAAGATTTTGATTATTACCCCCTTCTTTATCTTTACTATTAATTAGAAGAATAGTTGAAACTGGAACAG
 from argparse import ArgumentParser
 import pandas as pd
 import tqdm
-from Bio.SeqIO import parse
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.Seq import reverse_complement
 import sys
 
-def read_seqs(f):
+def read_seqs(f, seqids=None):
+    """
+    Reads sequences from a fasta file into a dictionary of header -> sequence
+
+    If seqids is given, only sequences with headers in seqids are kept
+    """
     records = {}
     with open(f, 'r') as fhin:
-        for record in tqdm.tqdm(parse(fhin, "fasta"), unit=" records", desc=f"reading {f}", leave=False):
-                seqid = record.description
-                records[seqid] = record
+        for seqid, seq in tqdm.tqdm(SimpleFastaParser(fhin), unit=" records", desc=f"reading {f}", leave=False):
+                if seqids is not None and seqid not in seqids:
+                    continue
+                records[seqid] = seq
     return records
 
 def read_hmmout(f):
@@ -106,12 +113,12 @@ def main(args):
     df_filtered = get_hmm_region(df, hmm_from, hmm_to, shift_start,pad_end)
     coord = read_coords(coordsfile)
     df = get_subseq_coord(df_filtered, coord)
-    dnarecs = read_seqs(dnafile)
+    dnarecs = read_seqs(dnafile, set(df.index))
     for seqid, d in df.iterrows():
         if d["strand"] == "-":
-            seq = dnarecs[seqid].seq.reverse_complement()
+            seq = reverse_complement(dnarecs[seqid])
         else:
-            seq = dnarecs[seqid].seq
+            seq = dnarecs[seqid]
         subseq = seq[d["subseq_start"]:d["subseq_end"]]
         if len(subseq) >= min_len:
             sys.stdout.write(f">{seqid}\n{subseq}\n")
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from Bio.SeqIO import parse
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 import pandas as pd
 from tqdm import tqdm
 
@@ -16,22 +16,30 @@ def read_info(f, replacements=None):
     return info.rename(columns=d)
 
 
+def sintax_labels(info, ranks):
+    """
+    Build the SINTAX taxonomy string for each record in the info table
+
+    :param info: info dataframe indexed by record id
+    :param ranks: ranks to include, in order
+    :return: dictionary of record id -> 'k:...,p:...' strings
+    """
+    labels = [info[rank].astype(str).radd(f"{rank[0]}:") for rank in ranks]
+    return dict(zip(info.index, labels[0].str.cat(labels[1:], sep=",")))
+
+
 def main(args):
     info = read_info(args.info, args.replace_rank)
     assert len(args.ranks) == len(
         set(info.columns).intersection(args.ranks)
     ), "not all ranks found in info file"
-    with open(args.outfile, "w") as fhout:
-        for record in tqdm(
-            parse(args.fasta, "fasta"), unit=" records", desc="formatting records"
+    labels = sintax_labels(info, args.ranks)
+    with open(args.fasta, "r") as fhin, open(args.outfile, "w") as fhout:
+        for title, seq in tqdm(
+            SimpleFastaParser(fhin), unit=" records", desc="formatting records"
         ):
-            taxlabels = [info.loc[record.id][x] for x in args.ranks]
-            taxprefix = [x[0] for x in args.ranks]
-            desc = ",".join(
-                [f"{taxprefix[x]}:{taxlabels[x]}" for x in range(0, len(taxlabels))]
-            )
-            header = f">{record.id};tax={desc}"
-            fhout.write(f"{header}\n{record.seq}\n")
+            seqid = title.split(None, 1)[0]
+            fhout.write(f">{seqid};tax={labels[seqid]}\n{seq}\n")
 
 
 if __name__ == "__main__":
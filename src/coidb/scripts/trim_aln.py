@@ -6,16 +6,15 @@ Trims an alignment to match an ASV sequence. This ASV sequence is assumed to hav
 
 
 from argparse import ArgumentParser
-from Bio.SeqIO import parse
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 import sys
 import pandas as pd
 
 def read_seqs(f):
     records = {}
     with open(f, 'r') as fhin:
-        for record in parse(fhin, "fasta"):
-                seqid = record.description
-                records[seqid] = record
+        for seqid, seq in SimpleFastaParser(fhin):
+                records[seqid] = seq
     return records
 
 def get_start(seq):
@@ -34,8 +33,7 @@ def get_end(seq):
 
 def get_start_end(records):
     pos_count = {}
-    for record in records.values():
-        seq = str(record.seq)
+    for seq in records.values():
         for i, x in enumerate(seq):
             if x != "-":
                 if i not in pos_count:
@@ -58,7 +56,7 @@ def get_start_end(records):
 def main(args):
     records = read_seqs(args.fasta)
     if "ASV" in records.keys():
-        asv = str(records["ASV"].seq)
+        asv = records["ASV"]
         start = get_start(asv)
         end = get_end(asv)
     else:
@@ -66,8 +64,8 @@ def main(args):
     sys.stderr.write(f"Found start {start} and end {end}\n")
     del records["ASV"]
     sys.stderr.write(f"Trimming alignments\n")
-    for seqid, record in records.items():
-        subseq = str(record.seq[start:end])
+    for seqid, seq in records.items():
+        subseq = seq[start:end]
         subseq = subseq.replace("-", "")
         if len(subseq) >= args.minlen:
             print(f">{seqid}\n{subseq}")